@@ -7,6 +7,8 @@ class BaseConfig():
     # Number of batchs to check metrics on validation dataset
     num_batches_validate = 1000
     batch_size = 128
+    # Number of impressions scored together in evaluation
+    num_impressions_a_batch = 256
     learning_rate = 0.0001
     num_workers = 4  # Number of workers for data loading
     num_clicked_news_a_user = 50  # Number of sampled click history for each user
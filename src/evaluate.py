@@ -3,7 +3,10 @@ from sklearn.metrics import roc_auc_score
 from tqdm import tqdm
 import torch
 from torch.utils.data import Dataset, DataLoader
+import os
 from os import path
+from pathlib import Path
+import hashlib
 import sys
 import pandas as pd
 from ast import literal_eval
@@ -39,9 +42,20 @@ def mrr_score(y_true, y_score):
     return np.sum(rr_score) / np.sum(y_true)
 
 
+def save_atomically(obj, target_path):
+    """
+    `torch.save` to a temporary file then move it into place, so an
+    interrupted or concurrent run never leaves a truncated file behind
+    """
+    temp_path = f'{target_path}.{os.getpid()}.tmp'
+    torch.save(obj, temp_path)
+    os.replace(temp_path, target_path)
+
+
 def value2rank(d):
-    values = list(d.values())
-    ranks = [sorted(values, reverse=True).index(x) for x in values]
+    values = -np.fromiter(d.values(), dtype=float, count=len(d))
+    # Tied values share the smallest rank, as `list.index` would give
+    ranks = np.searchsorted(np.sort(values), values, side='left').tolist()
     return {k: ranks[i] + 1 for i, k in enumerate(d.keys())}
 
 
@@ -51,27 +65,50 @@ class NewsDataset(Dataset):
     """
     def __init__(self, news_path):
         super(NewsDataset, self).__init__()
-        self.news_parsed = pd.read_table(
-            news_path,
-            usecols=['id'] + config.dataset_attributes['news'],
-            converters={
-                attribute: literal_eval
-                for attribute in set(config.dataset_attributes['news']) & set([
-                    'title', 'abstract', 'title_entities', 'abstract_entities'
-                ])
-            })
-        self.news2dict = self.news_parsed.to_dict('index')
-        for key1 in self.news2dict.keys():
-            for key2 in self.news2dict[key1].keys():
-                if type(self.news2dict[key1][key2]) != str:
-                    self.news2dict[key1][key2] = torch.tensor(
-                        self.news2dict[key1][key2])
+        # Parsed tensors are cached next to the TSV, since `literal_eval`
+        # on every cell dominates the construction time
+        cache_path = path.splitext(news_path)[0] + '.pt'
+        cache = None
+        if path.exists(cache_path) and path.getmtime(
+                cache_path) >= path.getmtime(news_path):
+            cache = torch.load(cache_path, mmap=True, weights_only=True)
+            if cache['attributes'] != config.dataset_attributes['news']:
+                cache = None
+        if cache is None:
+            news_parsed = pd.read_table(
+                news_path,
+                usecols=['id'] + config.dataset_attributes['news'],
+                converters={
+                    attribute: literal_eval
+                    for attribute in set(config.dataset_attributes['news'])
+                    & set([
+                        'title', 'abstract', 'title_entities',
+                        'abstract_entities'
+                    ])
+                })
+            # Column-major storage: one tensor per attribute instead of a
+            # dict of small tensors per row
+            cache = {
+                'attributes': config.dataset_attributes['news'],
+                'news_ids': news_parsed['id'].tolist(),
+                'columns': {
+                    attribute: torch.from_numpy(
+                        np.asarray(news_parsed[attribute].tolist(),
+                                   dtype=np.int64))
+                    for attribute in config.dataset_attributes['news']
+                }
+            }
+            save_atomically(cache, cache_path)
+        self.news_ids = cache['news_ids']
+        self.columns = cache['columns']
 
     def __len__(self):
-        return len(self.news_parsed)
+        return len(self.news_ids)
 
     def __getitem__(self, idx):
-        item = self.news2dict[idx]
+        item = {'id': self.news_ids[idx]}
+        for attribute, column in self.columns.items():
+            item[attribute] = column[idx]
         return item
 
 
@@ -79,7 +116,7 @@ class UserDataset(Dataset):
     """
     Load users for evaluation, duplicated rows will be dropped
     """
-    def __init__(self, behaviors_path, user2int_path):
+    def __init__(self, behaviors_path, user2int_path, news2int):
         super(UserDataset, self).__init__()
         self.behaviors = pd.read_table(behaviors_path,
                                        header=None,
@@ -88,36 +125,40 @@ class UserDataset(Dataset):
         self.behaviors.clicked_news.fillna(' ', inplace=True)
         self.behaviors.drop_duplicates(inplace=True)
         user2int = dict(pd.read_table(user2int_path).values.tolist())
-        user_total = 0
-        user_missed = 0
-        for row in self.behaviors.itertuples():
-            user_total += 1
-            if row.user in user2int:
-                self.behaviors.at[row.Index, 'user'] = user2int[row.user]
-            else:
-                user_missed += 1
-                self.behaviors.at[row.Index, 'user'] = 0
+        self.behaviors.user = self.behaviors.user.map(user2int).fillna(
+            0).astype(np.int64)
+
+        # Left-padded matrix of clicked news indices (see `news2int`),
+        # built once instead of per item
+        self.clicked_news = np.full(
+            (len(self.behaviors), config.num_clicked_news_a_user),
+            news2int['PADDED_NEWS'],
+            dtype=np.int64)
+        self.clicked_news_length = np.zeros(len(self.behaviors),
+                                            dtype=np.int64)
+        for i, clicked_news in enumerate(
+                self.behaviors.clicked_news.str.split()):
+            clicked_news = clicked_news[:config.num_clicked_news_a_user]
+            self.clicked_news_length[i] = len(clicked_news)
+            if clicked_news:
+                self.clicked_news[i, -len(clicked_news):] = [
+                    news2int[x] for x in clicked_news
+                ]
+        # Plain columns for row access, `iloc` is too slow per item
+        self.user = self.behaviors.user.to_numpy()
+        self.clicked_news_string = self.behaviors.clicked_news.tolist()
+        del self.behaviors
 
     def __len__(self):
-        return len(self.behaviors)
+        return len(self.clicked_news_string)
 
     def __getitem__(self, idx):
-        row = self.behaviors.iloc[idx]
         item = {
-            "user":
-            row.user,
-            "clicked_news_string":
-            row.clicked_news,
-            "clicked_news":
-            row.clicked_news.split()[:config.num_clicked_news_a_user]
+            "user": self.user[idx],
+            "clicked_news_string": self.clicked_news_string[idx],
+            "clicked_news": self.clicked_news[idx],
+            "clicked_news_length": self.clicked_news_length[idx]
         }
-        item['clicked_news_length'] = len(item["clicked_news"])
-        repeated_times = config.num_clicked_news_a_user - len(
-            item["clicked_news"])
-        assert repeated_times >= 0
-        item["clicked_news"] = ['PADDED_NEWS'
-                                ] * repeated_times + item["clicked_news"]
-
         return item
 
 
@@ -125,7 +166,7 @@ class BehaviorsDataset(Dataset):
     """
     Load behaviors for evaluation, (user, time) pair as session
     """
-    def __init__(self, behaviors_path):
+    def __init__(self, behaviors_path, news2int):
         super(BehaviorsDataset, self).__init__()
         self.behaviors = pd.read_table(behaviors_path,
                                        header=None,
@@ -136,22 +177,51 @@ class BehaviorsDataset(Dataset):
                                        ])
         self.behaviors.clicked_news.fillna(' ', inplace=True)
         self.behaviors.impressions = self.behaviors.impressions.str.split()
+        self.news2int = news2int
+        # Plain columns for row access, `iloc` is too slow per item. Only
+        # the columns `collate_behaviors` uses are kept
+        self.impression_id = self.behaviors.impression_id.tolist()
+        self.clicked_news = self.behaviors.clicked_news.tolist()
+        self.impressions = self.behaviors.impressions.tolist()
+        del self.behaviors
 
     def __len__(self):
-        return len(self.behaviors)
+        return len(self.impression_id)
 
     def __getitem__(self, idx):
-        row = self.behaviors.iloc[idx]
+        impressions = self.impressions[idx]
         item = {
-            "impression_id": row.impression_id,
-            "user": row.user,
-            "time": row.time,
-            "clicked_news_string": row.clicked_news,
-            "impressions": row.impressions
+            "impression_id": self.impression_id[idx],
+            "clicked_news_string": self.clicked_news[idx],
+            "candidate_news": [
+                self.news2int[news.split('-')[0]] for news in impressions
+            ],
+            "clicked": [int(news.split('-')[1]) for news in impressions]
         }
         return item
 
 
+def collate_behaviors(batch):
+    """
+    Collate impressions of different lengths into one batch, candidate news
+    are right-padded with index 0 and should be cut by `candidate_news_length`
+    """
+    candidate_news_length = [len(x['candidate_news']) for x in batch]
+    candidate_news = torch.zeros(len(batch),
+                                 max(candidate_news_length),
+                                 dtype=torch.long)
+    for i, x in enumerate(batch):
+        candidate_news[i, :candidate_news_length[i]] = torch.tensor(
+            x['candidate_news'])
+    return {
+        "impression_id": [x['impression_id'] for x in batch],
+        "clicked_news_string": [x['clicked_news_string'] for x in batch],
+        "candidate_news": candidate_news,
+        "candidate_news_length": candidate_news_length,
+        "clicked": [x['clicked'] for x in batch]
+    }
+
+
 def calculate_single_user_metric(pair):
     try:
         auc = roc_auc_score(*pair)
@@ -163,21 +233,18 @@ def calculate_single_user_metric(pair):
         return [np.nan] * 4
 
 
-@torch.no_grad()
-def evaluate(model, directory, num_workers, max_count=sys.maxsize):
+def calculate_news_matrix(model, news_path, mixed_precision=False):
     """
-    Evaluate model on target directory.
+    Calculate vectors for all news.
     Args:
         model: model to be evaluated
-        directory: the directory that contains two files (behaviors.tsv, news_parsed.tsv)
-        num_workers: processes number for calculating metrics
+        news_path: path of news_parsed.tsv
+        mixed_precision: run the news encoder under bfloat16 autocast
     Returns:
-        AUC
-        MRR
-        nDCG@5
-        nDCG@10
+        news2int: news id -> row index of news_matrix, 0 for 'PADDED_NEWS'
+        news_matrix: (num_news + 1) * word_embedding_dim, row 0 is all zeros
     """
-    news_dataset = NewsDataset(path.join(directory, 'news_parsed.tsv'))
+    news_dataset = NewsDataset(news_path)
     news_dataloader = DataLoader(news_dataset,
                                  batch_size=config.batch_size * 16,
                                  shuffle=False,
@@ -185,21 +252,96 @@ def evaluate(model, directory, num_workers, max_count=sys.maxsize):
                                  drop_last=False,
                                  pin_memory=True)
 
-    news2vector = {}
+    # Row i of `news_matrix` is the vector of the news whose index is i,
+    # row 0 is a zero vector reserved for padding
+    news2int = {'PADDED_NEWS': 0}
+    news_vectors = []
     for minibatch in tqdm(news_dataloader,
                           desc="Calculating vectors for news"):
         news_ids = minibatch["id"]
-        if any(id not in news2vector for id in news_ids):
-            news_vector = model.get_news_vector(minibatch)
-            for id, vector in zip(news_ids, news_vector):
-                if id not in news2vector:
-                    news2vector[id] = vector
-
-    news2vector['PADDED_NEWS'] = torch.zeros(
-        list(news2vector.values())[0].size())
+        if not news2int.keys() >= set(news_ids):
+            with torch.autocast(device_type=device.type,
+                                dtype=torch.bfloat16,
+                                enabled=mixed_precision):
+                news_vector = model.get_news_vector(minibatch).float()
+            new_rows = []
+            for i, id in enumerate(news_ids):
+                if id not in news2int:
+                    news2int[id] = len(news2int)
+                    new_rows.append(i)
+            news_vectors.append(news_vector[new_rows])
+
+    news_matrix = torch.cat(
+        [torch.zeros_like(news_vectors[0][:1])] + news_vectors, dim=0)
+
+    return news2int, news_matrix
+
+
+@torch.inference_mode()
+def evaluate(model,
+             directory,
+             num_workers,
+             max_count=sys.maxsize,
+             checkpoint_path=None,
+             mixed_precision=False):
+    """
+    Evaluate model on target directory.
+    Args:
+        model: model to be evaluated
+        directory: the directory that contains two files (behaviors.tsv, news_parsed.tsv)
+        num_workers: processes number for calculating metrics
+        checkpoint_path: checkpoint the model was loaded from, if given,
+            news vectors are cached under `directory/cache` and reused,
+            only the most recent cache entry is kept
+        mixed_precision: run the encoders under bfloat16 autocast where the
+            GPU supports it, vectors are cast back to float32 but keep the
+            bfloat16 rounding, so metrics may differ slightly from float32
+    Returns:
+        AUC
+        MRR
+        nDCG@5
+        nDCG@10
+    """
+    mixed_precision = mixed_precision and device.type == 'cuda' and \
+        torch.cuda.is_bf16_supported()
+    news_path = path.join(directory, 'news_parsed.tsv')
+    cache_path = None
+    if checkpoint_path is not None:
+        # News vectors depend on the checkpoint, the news file, the news
+        # attributes fed to the encoder and the precision it runs in
+        key = hashlib.md5(':'.join(
+            map(str, [
+                path.abspath(checkpoint_path),
+                path.getmtime(checkpoint_path),
+                path.getmtime(news_path),
+                config.dataset_attributes['news'], mixed_precision
+            ])).encode()).hexdigest()
+        cache_path = path.join(directory, 'cache', f'{key}.pt')
+
+    if cache_path is not None and path.exists(cache_path):
+        cache = torch.load(cache_path,
+                           map_location=device,
+                           weights_only=True)
+        news2int, news_matrix = cache['news2int'], cache['news_matrix']
+    else:
+        news2int, news_matrix = calculate_news_matrix(model, news_path,
+                                                      mixed_precision)
+        if cache_path is not None:
+            cache_directory = path.dirname(cache_path)
+            Path(cache_directory).mkdir(parents=True, exist_ok=True)
+            save_atomically(
+                {
+                    'news2int': news2int,
+                    'news_matrix': news_matrix.cpu()
+                }, cache_path)
+            # Only the latest entry is kept, older ones belong to other
+            # checkpoints or settings and would otherwise pile up
+            for x in os.listdir(cache_directory):
+                if x.endswith('.pt') and x != path.basename(cache_path):
+                    os.remove(path.join(cache_directory, x))
 
     user_dataset = UserDataset(path.join(directory, 'behaviors.tsv'),
-                               'data/train/user2int.tsv')
+                               'data/train/user2int.tsv', news2int)
     user_dataloader = DataLoader(user_dataset,
                                  batch_size=config.batch_size * 16,
                                  shuffle=False,
@@ -211,51 +353,61 @@ def evaluate(model, directory, num_workers, max_count=sys.maxsize):
     for minibatch in tqdm(user_dataloader,
                           desc="Calculating vectors for users"):
         user_strings = minibatch["clicked_news_string"]
-        if any(user_string not in user2vector for user_string in user_strings):
-            clicked_news_vector = torch.stack([
-                torch.stack([news2vector[x].to(device) for x in news_list],
-                            dim=0) for news_list in minibatch["clicked_news"]
-            ],
-                                              dim=0).transpose(0, 1)
-            user_vector = model.get_user_vector(clicked_news_vector)
+        if not user2vector.keys() >= set(user_strings):
+            # batch_size, num_clicked_news_a_user, word_embedding_dim
+            clicked_news_vector = news_matrix[minibatch["clicked_news"].to(
+                device, non_blocking=True)]
+            with torch.autocast(device_type=device.type,
+                                dtype=torch.bfloat16,
+                                enabled=mixed_precision):
+                user_vector = model.get_user_vector(
+                    clicked_news_vector).float()
             for user, vector in zip(user_strings, user_vector):
                 if user not in user2vector:
                     user2vector[user] = vector
 
-    behaviors_dataset = BehaviorsDataset(path.join(directory, 'behaviors.tsv'))
+    behaviors_dataset = BehaviorsDataset(path.join(directory, 'behaviors.tsv'),
+                                         news2int)
     behaviors_dataloader = DataLoader(behaviors_dataset,
-                                      batch_size=1,
+                                      batch_size=config.num_impressions_a_batch,
                                       shuffle=False,
-                                      num_workers=config.num_workers)
+                                      num_workers=config.num_workers,
+                                      collate_fn=collate_behaviors,
+                                      pin_memory=True)
 
+    # Metrics of each batch are calculated in the pool while the next batch
+    # is being scored
     count = 0
-
-    tasks = []
-
-    for minibatch in tqdm(behaviors_dataloader,
-                          desc="Calculating probabilities"):
-        count += 1
-        if count == max_count:
-            break
-
-        candidate_news_vector = torch.stack([
-            news2vector[news[0].split('-')[0]]
-            for news in minibatch['impressions']
-        ],
-                                            dim=0)
-        user_vector = user2vector[minibatch['clicked_news_string'][0]]
-        click_probability = model.get_prediction(candidate_news_vector,
-                                                 user_vector)
-
-        y_pred = click_probability.tolist()
-        y_true = [
-            int(news[0].split('-')[1]) for news in minibatch['impressions']
-        ]
-
-        tasks.append((y_true, y_pred))
-
+    pending = []
     with Pool(processes=num_workers) as pool:
-        results = pool.map(calculate_single_user_metric, tasks)
+        for minibatch in tqdm(behaviors_dataloader,
+                              desc="Calculating probabilities"):
+            # batch_size, max_candidate_size, word_embedding_dim
+            candidate_news_vector = news_matrix[minibatch['candidate_news'].to(
+                device, non_blocking=True)]
+            # batch_size, word_embedding_dim
+            user_vector = torch.stack([
+                user2vector[user_string]
+                for user_string in minibatch['clicked_news_string']
+            ],
+                                      dim=0)
+            # batch_size, max_candidate_size
+            click_probability = model.get_batch_prediction(
+                candidate_news_vector, user_vector).tolist()
+
+            # Keep the previous behaviour of scoring `max_count - 1`
+            # impressions
+            tasks = [(y_true, y_pred[:length])
+                     for y_pred, length, y_true in zip(
+                         click_probability, minibatch['candidate_news_length'],
+                         minibatch['clicked'])][:max_count - 1 - count]
+            count += len(tasks)
+            pending.append(
+                pool.map_async(calculate_single_user_metric, tasks))
+            if count >= max_count - 1:
+                break
+
+        results = [x for result in pending for x in result.get()]
 
     aucs, mrrs, ndcg5s, ndcg10s = np.array(results).T
     return np.nanmean(aucs), np.nanmean(mrrs), np.nanmean(ndcg5s), np.nanmean(
@@ -277,8 +429,18 @@ if __name__ == '__main__':
     checkpoint = torch.load(checkpoint_path)
     model.load_state_dict(checkpoint['model_state_dict'])
     model.eval()
-    auc, mrr, ndcg5, ndcg10 = evaluate(model, './data/test',
-                                       config.num_workers)
+    # Compile the encoders only, `get_*_vector` call them directly so
+    # compiling the whole model (i.e. `forward`) would not take effect.
+    # The default mode is used since CUDA graphs would reuse the output
+    # buffers that `user2vector` keeps views into
+    if hasattr(torch, 'compile'):
+        model.news_encoder = torch.compile(model.news_encoder, dynamic=True)
+        model.user_encoder = torch.compile(model.user_encoder, dynamic=True)
+    auc, mrr, ndcg5, ndcg10 = evaluate(model,
+                                       './data/test',
+                                       config.num_workers,
+                                       checkpoint_path=checkpoint_path,
+                                       mixed_precision=True)
     print(
         f'AUC: {auc:.4f}\nMRR: {mrr:.4f}\nnDCG@5: {ndcg5:.4f}\nnDCG@10: {ndcg10:.4f}'
     )
\ No newline at end of file
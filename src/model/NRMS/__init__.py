@@ -81,4 +81,15 @@ class NRMS(torch.nn.Module):
         # candidate_size
         return self.click_predictor(
             news_vector.unsqueeze(dim=0),
-            user_vector.unsqueeze(dim=0)).squeeze(dim=0)
\ No newline at end of file
+            user_vector.unsqueeze(dim=0)).squeeze(dim=0)
+
+    def get_batch_prediction(self, news_vector, user_vector):
+        """
+        Args:
+            news_vector: batch_size, candidate_size, word_embedding_dim
+            user_vector: batch_size, word_embedding_dim
+        Returns:
+            click_probability: batch_size, candidate_size
+        """
+        # batch_size, candidate_size
+        return self.click_predictor(news_vector, user_vector)
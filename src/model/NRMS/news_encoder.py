@@ -35,7 +35,8 @@ class NewsEncoder(torch.nn.Module):
             (shape) batch_size, word_embedding_dim
         """
         # batch_size, num_words_title, word_embedding_dim
-        news_vector = F.dropout(self.word_embedding(news["title"].to(device)),
+        news_vector = F.dropout(self.word_embedding(news["title"].to(
+            device, non_blocking=True)),
                                 p=self.config.dropout_probability,
                                 training=self.training)
         # batch_size, num_words_title, word_embedding_dim